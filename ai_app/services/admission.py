@@ -0,0 +1,151 @@
+import math
+import threading
+from contextlib import contextmanager
+from django.conf import settings
+
+# ==========================================
+#  准入控制 (Admission Control)
+#  每個池 = 同時執行上限 + 排隊上限 + 最長等待時間。
+#    - matting / cpu / encode / io : 階段池，分別限制去背 (rembg)、試穿的 CPU 運算 (取色、縮圖)、
+#                                    結果變體編碼與模型呼叫
+#    - remove_bg ...                 : 端點池，限制每個 API 同時處理的請求數
+#  排隊已滿或等太久就立即丟 Overloaded，由 view 轉成 503 + Retry-After，
+#  讓過載時延遲有上限，而不是無限堆積。
+# ==========================================
+
+class Overloaded(Exception):
+    def __init__(self, pool, reason, retry_after):
+        super().__init__(f"{pool} 忙碌中 ({reason})")
+        self.pool = pool
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """acquire() 取得的名額；release() 可重複呼叫，只會歸還一次。"""
+    def __init__(self, pool):
+        self._pool = pool
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._pool._release()
+
+
+class WorkPool:
+    def __init__(self, name, max_workers, max_queue, max_wait):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._slots = threading.BoundedSemaphore(max_workers)
+        self._lock = threading.Lock()
+        self.active = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = {"queue_full": 0, "timeout": 0}
+
+    @property
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.max_wait))
+
+    def _reject(self, reason):
+        self.rejected[reason] += 1
+        return Overloaded(self.name, reason, self.retry_after)
+
+    def acquire(self) -> Ticket:
+        with self._lock:
+            # 有空位就直接進；沒空位時排隊人數已達上限 -> 立即拒絕
+            if self.active >= self.max_workers and self.queued >= self.max_queue:
+                raise self._reject("queue_full")
+            self.queued += 1
+
+        acquired = self._slots.acquire(timeout=self.max_wait)
+
+        with self._lock:
+            self.queued -= 1
+            if not acquired:
+                raise self._reject("timeout")
+            self.active += 1
+            self.admitted += 1
+        return Ticket(self)
+
+    def _release(self):
+        with self._lock:
+            self.active -= 1
+        self._slots.release()
+
+    @contextmanager
+    def slot(self):
+        ticket = self.acquire()
+        try:
+            yield
+        finally:
+            ticket.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "max_wait": self.max_wait,
+                "active": self.active,
+                "queued": self.queued,
+                "admitted": self.admitted,
+                "rejected": dict(self.rejected),
+            }
+
+
+class ReleasingStream:
+    """
+    包住串流內容，回應結束 (或客戶端中斷) 時歸還名額。
+    Django 會呼叫 streaming_content 的 close()；尚未開始迭代的 generator
+    關閉時不會執行 finally，所以不能只靠 generator 自己釋放。
+    """
+    def __init__(self, iterable, ticket):
+        self._iterator = iter(iterable)
+        self._ticket = ticket
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._iterator)
+        except BaseException:
+            self._ticket.release()
+            raise
+
+    def close(self):
+        try:
+            close = getattr(self._iterator, "close", None)
+            if close:
+                close()
+        finally:
+            self._ticket.release()
+
+
+# ==========================================
+#  池登錄 (依 settings.AI_POOLS 建立，全程序共用)
+# ==========================================
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(name) -> WorkPool:
+    with _pools_lock:
+        pool = _pools.get(name)
+        if pool is None:
+            config = settings.AI_POOLS[name]
+            pool = WorkPool(name, config["max_workers"], config["max_queue"], config["max_wait"])
+            _pools[name] = pool
+        return pool
+
+
+def all_pool_stats():
+    for name in settings.AI_POOLS:
+        get_pool(name)
+    with _pools_lock:
+        pools = list(_pools.values())
+    return {pool.name: pool.stats() for pool in pools}
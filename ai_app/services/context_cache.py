@@ -0,0 +1,153 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+# ==========================================
+#  衣服上下文快取 (Garment Context Registry)
+#  同一件衣服試穿在不同人身上時，合成 prompt 的前半段 (模板 + 衣服圖 + 材質樣本
+#  + 分析結果) 完全相同。這裡以衣服內容雜湊為 key，記住：
+#    1. 本地分析結果 (取色 / AI 本色 / 結構分析)，命中時不必再問顧問模型
+#    2. 模型端 cached content 的 handle (cache name)，命中時只送後半段
+# ==========================================
+
+def is_stale_cache_error(exc) -> bool:
+    """
+    只有「快取 handle 無效」才退回完整內容 (google.genai.errors.APIError 的 code/status)。
+    429 / 5xx / 逾時等上游忙碌錯誤不算：此時重送完整前綴只會讓負載加倍。
+    """
+    code = getattr(exc, "code", None)
+    status = str(getattr(exc, "status", "") or "").upper()
+    return code in (400, 403, 404) or status == "NOT_FOUND"
+
+
+def garment_hash(pil_img) -> str:
+    # 用像素內容而不是檔名/檔案 bytes，同一張圖重新上傳也能命中
+    digest = hashlib.sha256()
+    digest.update(f"{pil_img.mode}:{pil_img.size}".encode())
+    digest.update(pil_img.tobytes())
+    return digest.hexdigest()
+
+
+class GarmentContext:
+    """一件衣服的可重用資料。cache_name 為模型端快取 handle (沒有時為 None)。"""
+    def __init__(self, garment_hash, hex_color, ai_true_color, garment_specs, texture_swatch, prefix_contents):
+        self.garment_hash = garment_hash
+        self.hex_color = hex_color
+        self.ai_true_color = ai_true_color
+        self.garment_specs = garment_specs
+        self.texture_swatch = texture_swatch
+        self.prefix_contents = prefix_contents
+        self.cache_name = None
+        self.cache_failed = False   # 建立失敗 (模型不支援 / token 數不足) 就不再重試
+        self.uses = 0
+        self.expires_at = 0.0
+        self.size_bytes = _estimate_size(prefix_contents)
+
+
+def _estimate_size(contents):
+    # 解碼後的像素大小 (寬 x 高 x 通道數) + 文字長度，用來限制登錄的總記憶體
+    total = 0
+    for item in contents:
+        if isinstance(item, str):
+            total += len(item.encode("utf-8"))
+        elif hasattr(item, "getbands"):
+            total += item.width * item.height * len(item.getbands())
+    return total
+
+
+class GarmentContextRegistry:
+    """
+    garment_hash -> GarmentContext，附 TTL 與總記憶體上限 (超過時 LRU 淘汰)。
+    clock 可注入，方便用假時鐘測試過期。
+    被淘汰/過期的項目若有模型端 handle，會記在 orphaned 清單，
+    由 AIProcessor 用 client.caches.delete 刪除 (登錄本身不持有 client)。
+    """
+    def __init__(self, ttl_seconds=3600, max_bytes=256 * 1024 * 1024, clock=time.monotonic):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._orphaned = []
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _remove(self, key, replacement=None):
+        entry = self._entries.pop(key)
+        self.total_bytes -= entry.size_bytes
+        if entry.cache_name and entry is not replacement:
+            self._orphaned.append(entry.cache_name)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry.expires_at <= self.clock():
+                self._remove(key)
+                entry = None
+            if not entry:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            entry.uses += 1
+            self.hits += 1
+            return entry
+
+    def put(self, entry):
+        """單一項目就超過上限時不登錄，回傳 False。"""
+        if entry.size_bytes > self.max_bytes:
+            return False
+        with self._lock:
+            if entry.garment_hash in self._entries:
+                self._remove(entry.garment_hash, replacement=entry)
+            entry.uses = max(entry.uses, 1)
+            entry.expires_at = self.clock() + self.ttl_seconds
+            self._entries[entry.garment_hash] = entry
+            self.total_bytes += entry.size_bytes
+            while self.total_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+        return True
+
+    def drop_cache_handle(self, key):
+        """模型端快取失效 (過期/被刪) 時呼叫：保留本地分析，只清掉 handle。"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                entry.cache_name = None
+                entry.cache_failed = True
+
+    def take_orphaned_handles(self):
+        """取出 (並清空) 待刪除的模型端快取 handle。"""
+        with self._lock:
+            names, self._orphaned = self._orphaned, []
+        return names
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._remove(key)
+            self.total_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# ==========================================
+#  全域設定 (環境變數)
+# ==========================================
+# 是否使用模型端 cached content (本地分析快取一律啟用)
+CONTEXT_CACHE_ENABLED = os.getenv("GEMINI_CONTEXT_CACHE", "1").lower() in ("1", "true", "yes")
+# 同一件衣服出現幾次才建立模型端快取 (建立快取本身有成本，只給熱門衣服用)
+CONTEXT_CACHE_MIN_USES = int(os.getenv("GEMINI_CONTEXT_CACHE_MIN_USES", 2))
+CONTEXT_CACHE_TTL = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL", 3600))
+# 快取裡的衣服圖/材質樣本縮到這個最長邊 (px)
+CONTEXT_IMAGE_MAX_EDGE = int(os.getenv("GEMINI_CONTEXT_IMAGE_MAX_EDGE", 1024))
+# 模型端 TTL 比本地多留一點，避免本地還有效、遠端卻已過期
+REMOTE_TTL_MARGIN = 120
+
+garment_registry = GarmentContextRegistry(
+    ttl_seconds=CONTEXT_CACHE_TTL,
+    max_bytes=int(os.getenv("GEMINI_CONTEXT_CACHE_MAX_BYTES", 256 * 1024 * 1024)),
+)
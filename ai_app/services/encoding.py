@@ -0,0 +1,353 @@
+import os
+import time
+import logging
+import threading
+from django.conf import settings
+from PIL import Image, features
+from .admission import get_pool
+
+# 設定日誌
+logger = logging.getLogger(__name__)
+
+# ==========================================
+#  輸出格式表 (格式代號 -> PIL 格式, MIME, 副檔名)
+# ==========================================
+OUTPUT_FORMATS = {
+    "png":  ("PNG",  "image/png",  "png"),
+    "jpeg": ("JPEG", "image/jpeg", "jpg"),
+    "webp": ("WEBP", "image/webp", "webp"),
+    "avif": ("AVIF", "image/avif", "avif"),
+}
+
+FORMAT_ALIASES = {"jpg": "jpeg"}
+
+# Accept 同分時的伺服器偏好順序 (體積由小到大)
+SERVER_PREFERENCE = ["avif", "webp", "jpeg", "png"]
+
+# 變體只允許固定幾檔品質/尺寸，任意數值會被對齊到最近的檔位，
+# 每個結果最多只會有幾十個變體 (公開 GET 也打不爆磁碟/CPU)
+QUALITY_PRESETS = (40, 60, 80, 90)
+EDGE_PRESETS = (256, 512, 1024, 2048)
+
+# 各格式預設品質 (有損模式，需在 QUALITY_PRESETS 內)
+DEFAULT_QUALITY = {"jpeg": 80, "webp": 80, "avif": 60}
+
+# 變體快取目錄 (放在 MEDIA_ROOT 底下)
+VARIANT_DIR = "variants"
+
+
+class OutputFormatError(ValueError):
+    """
+    輸出參數錯誤。
+    status 對應 HTTP 狀態碼：400 (參數不合法) / 406 (伺服器不支援該格式)
+    """
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class VariantEncodeError(Exception):
+    """伺服器端轉檔失敗 (編碼器錯誤、磁碟已滿…)，對應 500，不是上傳圖片的問題。"""
+    pass
+
+
+def _snap_quality(quality):
+    return min(QUALITY_PRESETS, key=lambda preset: (abs(preset - quality), -preset))
+
+
+def _snap_edge(edge):
+    # 往下取最近的檔位 (不超過要求的大小)，最小檔位為下限
+    fitting = [preset for preset in EDGE_PRESETS if preset <= edge]
+    return fitting[-1] if fitting else EDGE_PRESETS[0]
+
+
+def is_format_available(fmt) -> bool:
+    # AVIF 需要 Pillow >= 11.3 或 pillow-avif-plugin，其餘格式 Pillow 內建
+    if fmt == "avif":
+        try:
+            import pillow_avif  # noqa: F401  (舊版 Pillow 的外掛，匯入即註冊)
+        except ImportError:
+            pass
+        return "AVIF" in Image.SAVE or bool(features.check("avif"))
+    if fmt == "webp":
+        return bool(features.check("webp"))
+    return True
+
+
+class OutputSpec:
+    """
+    一次輸出請求的規格：格式、品質、是否無損、縮圖邊長。
+    key 用於組成快取檔名，同一規格只會編碼一次。
+    """
+    def __init__(self, fmt="png", quality=None, lossless=False, max_edge=None):
+        self.format = fmt
+        self.quality = quality
+        self.lossless = lossless
+        self.max_edge = max_edge
+
+    @property
+    def pil_format(self):
+        return OUTPUT_FORMATS[self.format][0]
+
+    @property
+    def content_type(self):
+        return OUTPUT_FORMATS[self.format][1]
+
+    @property
+    def extension(self):
+        return OUTPUT_FORMATS[self.format][2]
+
+    @property
+    def is_original(self) -> bool:
+        # PNG 原尺寸 = 直接回傳原始結果檔，不需要重新編碼
+        return self.format == "png" and not self.max_edge
+
+    @property
+    def key(self) -> str:
+        parts = [self.format]
+        if self.lossless:
+            parts.append("lossless")
+        elif self.quality is not None:
+            parts.append(f"q{self.quality}")
+        if self.max_edge:
+            parts.append(f"e{self.max_edge}")
+        return "_".join(parts)
+
+    def __repr__(self):
+        return f"OutputSpec({self.key})"
+
+
+# ==========================================
+#  [協商] 1. 解析 Accept 標頭
+# ==========================================
+def _parse_accept(accept_header):
+    """回傳 {mime: q}，只保留明確列出的 image/* 類型 (萬用字元不算)。"""
+    accepted = {}
+    for item in (accept_header or "").split(","):
+        fields = [f.strip() for f in item.split(";")]
+        mime = fields[0].lower()
+        if not mime.startswith("image/") or mime == "image/*":
+            continue
+        q = 1.0
+        for param in fields[1:]:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        accepted[mime] = q
+    return accepted
+
+
+def _negotiate_format(accept_header):
+    accepted = _parse_accept(accept_header)
+    candidates = []
+    for rank, fmt in enumerate(SERVER_PREFERENCE):
+        q = accepted.get(OUTPUT_FORMATS[fmt][1], 0.0)
+        if q > 0 and is_format_available(fmt):
+            candidates.append((-q, rank, fmt))
+    # 沒有明確要求任何圖片格式 (例如 */*) 時維持舊行為：PNG
+    return min(candidates)[2] if candidates else "png"
+
+
+# ==========================================
+#  [協商] 2. 由請求參數 + Accept 建立輸出規格
+# ==========================================
+def parse_output_spec(params, accept_header="") -> OutputSpec:
+    """
+    params: 類 dict 物件 (request.GET / request.POST)
+      - format   : png / jpeg (jpg) / webp / avif，未指定時依 Accept 協商
+      - quality  : 1-100 (有損格式)，對齊到 QUALITY_PRESETS
+      - lossless : 1/true (僅 WebP)
+      - max_edge : 縮圖最長邊 (px)，對齊到 EDGE_PRESETS
+    """
+    raw_format = (params.get("format") or "").strip().lower()
+    if raw_format:
+        fmt = FORMAT_ALIASES.get(raw_format, raw_format)
+        if fmt not in OUTPUT_FORMATS:
+            raise OutputFormatError(f"不支援的輸出格式: {raw_format}")
+        if not is_format_available(fmt):
+            raise OutputFormatError(f"伺服器未啟用 {fmt.upper()} 編碼", status=406)
+    else:
+        fmt = _negotiate_format(accept_header)
+
+    lossless = str(params.get("lossless", "")).lower() in ("1", "true", "yes")
+    if lossless and fmt != "webp":
+        raise OutputFormatError("lossless 僅支援 webp")
+
+    quality = None
+    raw_quality = params.get("quality")
+    if raw_quality not in (None, ""):
+        if fmt == "png":
+            raise OutputFormatError("PNG 為無損格式，不接受 quality 參數")
+        try:
+            quality = int(raw_quality)
+        except ValueError:
+            raise OutputFormatError("quality 必須是整數")
+        if not 1 <= quality <= 100:
+            raise OutputFormatError("quality 範圍為 1-100")
+        quality = _snap_quality(quality)
+    if quality is None and not lossless and fmt in DEFAULT_QUALITY:
+        quality = DEFAULT_QUALITY[fmt]
+
+    max_edge = None
+    raw_edge = params.get("max_edge")
+    if raw_edge not in (None, ""):
+        try:
+            max_edge = int(raw_edge)
+        except ValueError:
+            raise OutputFormatError("max_edge 必須是整數")
+        if max_edge < 1:
+            raise OutputFormatError("max_edge 必須大於 0")
+        max_edge = _snap_edge(max_edge)
+
+    return OutputSpec(fmt, quality=quality, lossless=lossless, max_edge=max_edge)
+
+
+# ==========================================
+#  [編碼] 3. 產生 (或取用快取的) 變體檔
+# ==========================================
+def _encode(source_path, spec, dest_path):
+    with Image.open(source_path) as img:
+        img.load()
+        if spec.max_edge and max(img.size) > spec.max_edge:
+            img.thumbnail((spec.max_edge, spec.max_edge), Image.LANCZOS)
+
+        save_kwargs = {}
+        if spec.format == "jpeg":
+            # JPEG 沒有透明通道：去背結果貼到白底
+            if img.mode in ("RGBA", "LA", "P"):
+                rgba = img.convert("RGBA")
+                background = Image.new("RGB", rgba.size, (255, 255, 255))
+                background.paste(rgba, mask=rgba.split()[-1])
+                img = background
+            else:
+                img = img.convert("RGB")
+            save_kwargs.update(quality=spec.quality, optimize=True, progressive=True)
+        elif spec.format == "webp":
+            if spec.lossless:
+                save_kwargs.update(lossless=True, quality=100, method=6)
+            else:
+                save_kwargs.update(quality=spec.quality, method=4)
+        elif spec.format == "avif":
+            save_kwargs.update(quality=spec.quality)
+        else:
+            save_kwargs.update(optimize=True)
+
+        # 先寫暫存檔再 rename，避免並發請求讀到寫一半的檔案
+        tmp_path = f"{dest_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        img.save(tmp_path, format=spec.pil_format, **save_kwargs)
+    os.replace(tmp_path, dest_path)
+
+
+def get_variant_path(source_path, spec, admission=True) -> str:
+    """
+    回傳符合 spec 的檔案路徑。
+    原始 PNG 直接回傳；其他變體只編碼一次，之後從 MEDIA_ROOT/variants 取用。
+    轉檔失敗時丟 VariantEncodeError。
+    admission=True 時新變體的編碼佔用獨立的 encode 池 (不搶試穿用的 cpu 名額)；
+    admission=False：結果剛花成本算出來 (POST 回應)，不經過任何池，不會被過載丟棄。
+    """
+    if spec.is_original:
+        return source_path
+
+    variant_dir = os.path.join(settings.MEDIA_ROOT, VARIANT_DIR)
+    os.makedirs(variant_dir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(source_path))[0]
+    dest_path = os.path.join(variant_dir, f"{stem}__{spec.key}.{spec.extension}")
+
+    if os.path.exists(dest_path):
+        # 更新 mtime，讓清理時優先刪掉沒人用的變體
+        # (ETag 快取以 inode/大小為 key，不受 mtime 影響，不會因此重新雜湊)
+        try:
+            os.utime(dest_path)
+        except OSError:
+            pass
+        return dest_path
+
+    try:
+        if admission:
+            with get_pool("encode").slot():
+                _encode(source_path, spec, dest_path)
+        else:
+            _encode(source_path, spec, dest_path)
+    except (OSError, ValueError) as e:
+        logger.error(f"❌ [Encode] {stem} -> {spec.key} 失敗: {e}")
+        raise VariantEncodeError(f"轉檔失敗 ({spec.key}): {e}") from e
+
+    logger.info(
+        f"🗜️ [Encode] {stem} -> {spec.key}: "
+        f"{os.path.getsize(source_path)} -> {os.path.getsize(dest_path)} bytes"
+    )
+    maybe_prune_variants()
+    return dest_path
+
+
+# ==========================================
+#  [清理] 4. 變體快取目錄
+#  刪除：過期 (AI_VARIANT_MAX_AGE) / 原檔已不存在 / 殘留暫存檔；
+#  總大小超過 AI_VARIANT_MAX_BYTES 時再從最久沒用的開始刪。
+# ==========================================
+_prune_lock = threading.Lock()
+_last_prune = 0.0
+
+
+def prune_variants(now=None):
+    """回傳刪除的檔案數。"""
+    variant_dir = os.path.join(settings.MEDIA_ROOT, VARIANT_DIR)
+    if not os.path.isdir(variant_dir):
+        return 0
+
+    now = now if now is not None else time.time()
+    max_age = getattr(settings, "AI_VARIANT_MAX_AGE", 7 * 24 * 3600)
+    max_bytes = getattr(settings, "AI_VARIANT_MAX_BYTES", 1024 ** 3)
+
+    removed = 0
+    kept = []
+    for entry in os.scandir(variant_dir):
+        if not entry.is_file():
+            continue
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        age = now - stat.st_mtime
+        stem = entry.name.split("__", 1)[0]
+        source_exists = os.path.exists(os.path.join(settings.MEDIA_ROOT, f"{stem}.png"))
+        stale_tmp = entry.name.endswith(".tmp") and age > 3600
+
+        if age > max_age or stale_tmp or (not entry.name.endswith(".tmp") and not source_exists):
+            try:
+                os.remove(entry.path)
+                removed += 1
+            except OSError:
+                pass
+        elif not entry.name.endswith(".tmp"):
+            kept.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in kept)
+    for mtime, size, path in sorted(kept):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            removed += 1
+            total -= size
+        except OSError:
+            pass
+
+    if removed:
+        logger.info(f"🧹 [Encode] 清理變體 {removed} 個")
+    return removed
+
+
+def maybe_prune_variants():
+    """每 AI_VARIANT_PRUNE_INTERVAL 秒最多清理一次 (在產生新變體時順便觸發)。"""
+    global _last_prune
+    interval = getattr(settings, "AI_VARIANT_PRUNE_INTERVAL", 600)
+    now = time.time()
+    with _prune_lock:
+        if now - _last_prune < interval:
+            return 0
+        _last_prune = now
+    return prune_variants(now)
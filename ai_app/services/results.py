@@ -0,0 +1,138 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from django.conf import settings
+
+# ==========================================
+#  結果檔定位：result_id = MEDIA_ROOT 底下 PNG 原檔的檔名 (不含副檔名)
+# ==========================================
+def result_id_for(result_path) -> str:
+    return os.path.splitext(os.path.basename(result_path))[0]
+
+
+def resolve_result_path(result_id):
+    """找不到 (或 id 含路徑字元) 時回傳 None。"""
+    if not result_id or os.sep in result_id or "/" in result_id or result_id.startswith("."):
+        return None
+    path = os.path.join(settings.MEDIA_ROOT, f"{result_id}.png")
+    return path if os.path.isfile(path) else None
+
+
+# ==========================================
+#  強 ETag：內容雜湊 (同一檔案只算一次)
+# ==========================================
+_ETAG_CACHE_SIZE = 1024
+_etag_cache = OrderedDict()
+_etag_lock = threading.Lock()
+
+
+def content_etag(path) -> str:
+    stat = os.stat(path)
+    # 不用 mtime：變體命中時會 utime 更新 LRU 時間，內容並沒有變。
+    # 檔案一律以 os.replace 寫入，內容改變時 inode 也會改變。
+    cache_key = (path, stat.st_ino, stat.st_size)
+
+    with _etag_lock:
+        etag = _etag_cache.get(cache_key)
+        if etag:
+            _etag_cache.move_to_end(cache_key)
+            return etag
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    etag = f'"{digest.hexdigest()[:32]}"'
+
+    with _etag_lock:
+        _etag_cache[cache_key] = etag
+        if len(_etag_cache) > _ETAG_CACHE_SIZE:
+            _etag_cache.popitem(last=False)
+    return etag
+
+
+def etag_matches(if_none_match, etag) -> bool:
+    # If-None-Match 採弱比較 (RFC 9110 13.1.2)：忽略 W/ 前綴
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return any(tag.removeprefix("W/") == etag for tag in candidates)
+
+
+# ==========================================
+#  Range 解析 (只支援單一區段，多區段時回傳完整檔案)
+# ==========================================
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(range_header, size):
+    """
+    回傳 (start, end) (含 end)，或 None 代表應回傳完整內容。
+    語法不合法 (例如 bytes=5-3) 依 RFC 9110 14.1.1 忽略 Range -> None；
+    起點超出檔案大小才丟 RangeNotSatisfiable (416)。
+    """
+    if not range_header or not range_header.startswith("bytes="):
+        return None
+    spec = range_header[len("bytes="):].strip()
+    if "," in spec:
+        return None
+
+    start_str, sep, end_str = spec.partition("-")
+    if not sep:
+        return None
+    try:
+        if start_str == "":
+            # bytes=-500 : 最後 500 bytes
+            suffix = int(end_str)
+            if suffix < 0:
+                return None
+            if suffix == 0:
+                raise RangeNotSatisfiable()
+            start, end = max(size - suffix, 0), size - 1
+        else:
+            start = int(start_str)
+            end = int(end_str) if end_str else size - 1
+            if start < 0 or (end_str and end < start):
+                return None
+            end = min(end, size - 1)
+    except ValueError:
+        return None
+
+    if start >= size:
+        raise RangeNotSatisfiable()
+    return start, end
+
+
+def iter_file_range(path, start, length, chunk_size=64 * 1024):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = length
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+# ==========================================
+#  Sendfile 卸載：交給前端代理送出實際 bytes
+# ==========================================
+def sendfile_header(path):
+    """
+    依 AI_RESULT_SENDFILE 設定回傳 (header 名稱, 值)；未啟用時回傳 None。
+      - x-accel-redirect : nginx internal location (AI_RESULT_ACCEL_PREFIX + MEDIA_ROOT 相對路徑)
+      - x-sendfile       : Apache/lighttpd，直接給絕對路徑
+    """
+    mode = (getattr(settings, "AI_RESULT_SENDFILE", "") or "").lower()
+    if mode == "x-accel-redirect":
+        prefix = getattr(settings, "AI_RESULT_ACCEL_PREFIX", "/protected-media/")
+        rel_path = os.path.relpath(path, settings.MEDIA_ROOT).replace(os.sep, "/")
+        return "X-Accel-Redirect", prefix.rstrip("/") + "/" + rel_path
+    if mode == "x-sendfile":
+        return "X-Sendfile", os.path.abspath(path)
+    return None
@@ -0,0 +1,212 @@
+import os
+import time
+import logging
+import importlib
+import threading
+
+# 設定日誌
+logger = logging.getLogger(__name__)
+
+# ==========================================
+#  重量級依賴延遲載入 + 預熱 (Warm-up)
+#  rembg (onnxruntime) 與 google-genai 匯入很慢，不應該讓 migrate 等
+#  manage.py 指令付這個成本。這裡集中管理：第一次使用時才匯入，並記錄耗時；
+#  伺服器啟動時可在背景先預熱，/readyz 依各元件目前狀態回報。
+#
+#  鎖的分工：匯入/載入模型很慢，只用各自的建構鎖 (_rembg_lock / _client_lock)
+#  避免重複建立；_state_lock 只在寫入/讀取狀態時短暫持有，探測永遠不會被卡住。
+# ==========================================
+
+REMBG_MODEL = os.getenv("REMBG_MODEL", "u2net")
+
+# 預熱失敗後的重試間隔 (秒)：5, 10, 20 ... 最多 300
+WARMUP_RETRY_BASE = 5
+WARMUP_RETRY_MAX = 300
+
+_PROCESS_START = time.time()
+
+_state_lock = threading.Lock()
+_rembg_lock = threading.Lock()
+_client_lock = threading.Lock()
+
+_modules = {}
+_rembg_session = None
+_genai_client = None
+_warmup_thread = None
+_warmup_failures = 0
+_next_retry_at = 0.0
+
+# 狀態：cold -> warming -> ready / failed
+_state = {
+    "status": "cold",
+    "import_seconds": {},
+    "warmup_seconds": None,
+    "components": {"rembg_session": False, "genai_client": False},
+    "errors": {},
+}
+
+
+def uptime_seconds():
+    # 只讀程序啟動時間，不碰任何共用狀態 (給 /healthz 用)
+    return round(time.time() - _PROCESS_START, 1)
+
+
+def _record(component=None, ok=None, error=None, timing=None):
+    with _state_lock:
+        if timing:
+            _state["import_seconds"].update(timing)
+        if component:
+            if ok is not None:
+                _state["components"][component] = ok
+            if error:
+                _state["errors"][component] = error
+            elif ok:
+                _state["errors"].pop(component, None)
+
+
+def _timed_import(name):
+    module = _modules.get(name)
+    if module is not None:
+        return module
+    # import 本身由 Python 的匯入鎖保護，不需要再持有我們的鎖
+    started = time.perf_counter()
+    module = importlib.import_module(name)
+    elapsed = round(time.perf_counter() - started, 3)
+    if _modules.setdefault(name, module) is module:
+        _record(timing={name: elapsed})
+        logger.info(f"📦 [Runtime] import {name}: {elapsed}s")
+    return module
+
+
+# ==========================================
+#  [載入] 1. rembg (去背模型 session 只建立一次)
+# ==========================================
+def get_rembg_remove():
+    return _timed_import("rembg").remove
+
+
+def get_rembg_session():
+    global _rembg_session
+    if _rembg_session is not None:
+        return _rembg_session
+    with _rembg_lock:
+        if _rembg_session is None:
+            rembg = _timed_import("rembg")
+            started = time.perf_counter()
+            try:
+                session = rembg.new_session(REMBG_MODEL)
+            except Exception as e:
+                _record("rembg_session", ok=False, error=str(e))
+                raise
+            elapsed = round(time.perf_counter() - started, 3)
+            _rembg_session = session
+            _record("rembg_session", ok=True, timing={f"rembg_session:{REMBG_MODEL}": elapsed})
+            logger.info(f"🧠 [Runtime] rembg session ({REMBG_MODEL}) 載入: {elapsed}s")
+    return _rembg_session
+
+
+# ==========================================
+#  [載入] 2. google-genai (Client 全程序共用)
+# ==========================================
+def load_genai():
+    return _timed_import("google.genai")
+
+
+def load_genai_types():
+    return _timed_import("google.genai.types")
+
+
+def get_genai_client():
+    """沒有 GOOGLE_API_KEY 或建立失敗時回傳 None (與舊行為相同)，下次呼叫會再試。"""
+    global _genai_client
+    if _genai_client is not None:
+        return _genai_client
+    with _client_lock:
+        if _genai_client is None:
+            api_key = os.getenv("GOOGLE_API_KEY")
+            if not api_key:
+                _record("genai_client", ok=False, error="GOOGLE_API_KEY 未設定")
+                return None
+            try:
+                client = load_genai().Client(api_key=api_key)
+            except Exception as e:
+                logger.error(f"⚠️ Gemini Client 初始化失敗: {e}")
+                _record("genai_client", ok=False, error=str(e))
+                return None
+            _genai_client = client
+            _record("genai_client", ok=True)
+    return _genai_client
+
+
+# ==========================================
+#  [預熱] 3. 一次載入全部依賴
+# ==========================================
+def warm_up():
+    global _warmup_failures, _next_retry_at
+    with _state_lock:
+        _state["status"] = "warming"
+
+    started = time.perf_counter()
+    ok = True
+    for name, step in (("rembg_session", get_rembg_session), ("genai_types", load_genai_types)):
+        try:
+            step()
+        except Exception as e:
+            logger.error(f"❌ [Runtime] {name} 預熱失敗: {e}")
+            _record(name, error=str(e))
+            ok = False
+
+    if get_genai_client() is None:
+        ok = False
+
+    elapsed = round(time.perf_counter() - started, 3)
+    with _state_lock:
+        _state["warmup_seconds"] = elapsed
+        _state["status"] = "ready" if ok else "failed"
+        if ok:
+            _warmup_failures = 0
+        else:
+            _warmup_failures += 1
+            backoff = min(WARMUP_RETRY_BASE * 2 ** (_warmup_failures - 1), WARMUP_RETRY_MAX)
+            _next_retry_at = time.monotonic() + backoff
+    print(f"🔥 [Runtime] 預熱完成: {'ready' if ok else 'failed'} ({elapsed}s)")
+    return ok
+
+
+def start_background_warmup():
+    """
+    伺服器啟動時呼叫 (wsgi/asgi)，/readyz 未就緒時也會呼叫。
+    已就緒或正在預熱時不做事；上次失敗則等退避時間過後再重試。
+    """
+    global _warmup_thread
+    with _state_lock:
+        if _is_ready_locked():
+            return None
+        if _warmup_thread is not None and _warmup_thread.is_alive():
+            return _warmup_thread
+        if _state["status"] == "failed" and time.monotonic() < _next_retry_at:
+            return None
+        _state["status"] = "warming"
+        _warmup_thread = threading.Thread(target=warm_up, name="ai-warmup", daemon=True)
+        _warmup_thread.start()
+        return _warmup_thread
+
+
+def _is_ready_locked():
+    # 依元件目前狀態判斷：預熱失敗後若延遲載入成功，也會轉為就緒
+    return all(_state["components"].values())
+
+
+def readiness():
+    """回傳 (是否就緒, 狀態報告)。只短暫持有狀態鎖，不會等模型載入。"""
+    with _state_lock:
+        ready = _is_ready_locked()
+        report = {
+            "status": "ready" if ready else _state["status"],
+            "components": dict(_state["components"]),
+            "import_seconds": dict(_state["import_seconds"]),
+            "warmup_seconds": _state["warmup_seconds"],
+            "errors": dict(_state["errors"]),
+            "uptime_seconds": uptime_seconds(),
+        }
+    return ready, report
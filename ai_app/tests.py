@@ -1,3 +1,538 @@
-from django.test import TestCase
+import io
+import json
+import os
+import shutil
+import hashlib
+import tempfile
+from unittest import mock
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.conf import settings
+from django.test import SimpleTestCase, override_settings
+from django.urls import reverse
+from PIL import Image
 
-# Create your tests here.
+from .services.admission import Overloaded, ReleasingStream, WorkPool, get_pool
+from .services.context_cache import GarmentContext, GarmentContextRegistry
+from .services.encoding import get_variant_path, parse_output_spec
+from .services.processing import AIProcessor
+from .services.results import RangeNotSatisfiable, content_etag, etag_matches, parse_range
+
+
+# ==========================================
+#  假 Gemini Client (不需要安裝 google-genai)
+# ==========================================
+class FakePart:
+    def __init__(self, text=None, image=None):
+        self.text = text
+        self.inline_data = image is not None
+        self._image = image
+
+    def as_image(self):
+        return self._image
+
+
+class FakeAPIError(Exception):
+    """仿 google.genai.errors.APIError (code / status)。"""
+    def __init__(self, code, status, message=""):
+        super().__init__(f"{code} {status}. {message}")
+        self.code = code
+        self.status = status
+
+
+class FakeResponse:
+    def __init__(self, text=None, parts=None):
+        self.text = text
+        self.parts = parts or []
+
+
+class FakeModels:
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    def generate_content(self, model, contents, config=None):
+        self.calls.append({"model": model, "contents": contents, "config": config})
+        if model == "gemini-1.5-pro":
+            if self.client.fail_analysis:
+                raise RuntimeError("analysis unavailable")
+            return FakeResponse(text="Top, long sleeve")
+        if model == "gemini-1.5-flash":
+            if (config or {}).get("response_mime_type") == "application/json":
+                # 品管：依序回傳預先排好的判定，沒有時視為通過
+                verdict = self.client.qa_verdicts.pop(0) if self.client.qa_verdicts else (True, "ok")
+                return FakeResponse(text=json.dumps({"pass": verdict[0], "reason": verdict[1]}))
+            return FakeResponse(text="Pink (#ff66aa)")
+
+        cached = (config or {}).get("cached_content")
+        if cached and cached in self.client.stale_caches:
+            raise FakeAPIError(404, "NOT_FOUND", f"{cached} not found")
+        if self.client.synthesis_error:
+            raise self.client.synthesis_error
+        return FakeResponse(parts=[FakePart(image=Image.new("RGB", (32, 32)))])
+
+    def generate_content_stream(self, model, contents, config=None):
+        self.calls.append({"model": model, "contents": contents, "config": config, "stream": True})
+        failure = self.client.stream_failures.pop(len(self.synthesis_calls()) - 1, None)
+        if failure:
+            raise failure
+        cached = (config or {}).get("cached_content")
+        if cached and cached in self.client.stale_caches:
+            raise FakeAPIError(404, "NOT_FOUND", f"{cached} not found")
+        yield FakeResponse(parts=[FakePart(text="Rendering")])
+        yield FakeResponse(parts=[FakePart(image=Image.new("RGB", (32, 32)))])
+
+    def synthesis_calls(self):
+        return [call for call in self.calls if call["model"] == "test-synthesis-model"]
+
+
+class FakeCache:
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeCaches:
+    def __init__(self):
+        self.created = []
+        self.deleted = []
+
+    def create(self, model, config):
+        self.created.append({"model": model, "config": config})
+        return FakeCache(f"cachedContents/{len(self.created)}")
+
+    def delete(self, name):
+        self.deleted.append(name)
+
+
+class FakeClient:
+    def __init__(self):
+        self.fail_analysis = False
+        self.stale_caches = set()
+        self.synthesis_error = None
+        self.qa_verdicts = []
+        self.stream_failures = {}   # 第 N 次合成呼叫 -> 要丟出的例外
+        self.models = FakeModels(self)
+        self.caches = FakeCaches()
+
+
+def _png(color, size=(64, 64)):
+    buffer = io.BytesIO()
+    Image.new("RGBA", size, color).save(buffer, "PNG")
+    buffer.seek(0)
+    return buffer
+
+
+class TempMediaRootMixin:
+    """每個測試使用獨立的暫存 MEDIA_ROOT。"""
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+
+def _context(key, size=(10, 10)):
+    return GarmentContext(key, "#000000", "Black", "Top", None, [Image.new("RGB", size)])
+
+
+# ==========================================
+#  1. 衣服上下文登錄 (TTL / LRU)
+# ==========================================
+class GarmentContextRegistryTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.registry = GarmentContextRegistry(ttl_seconds=100, max_bytes=700, clock=lambda: self.now)
+
+    def test_entry_expires_after_ttl(self):
+        self.registry.put(_context("a"))
+        self.now = 99
+        self.assertIsNotNone(self.registry.get("a"))
+        self.now = 100
+        self.assertIsNone(self.registry.get("a"))
+        self.assertEqual(self.registry.total_bytes, 0)
+
+    def test_least_recently_used_is_evicted_by_bytes(self):
+        # 每筆 10x10 RGB = 300 bytes，上限 700 只放得下兩筆
+        self.registry.put(_context("a"))
+        self.registry.put(_context("b"))
+        self.registry.get("a")
+        self.registry.put(_context("c"))
+
+        self.assertIsNotNone(self.registry.get("a"))
+        self.assertIsNone(self.registry.get("b"))
+        self.assertIsNotNone(self.registry.get("c"))
+        self.assertEqual(self.registry.total_bytes, 600)
+
+    def test_evicted_and_expired_handles_are_orphaned(self):
+        for key in ("a", "b", "c"):
+            ctx = _context(key)
+            ctx.cache_name = f"cachedContents/{key}"
+            self.registry.put(ctx)
+        self.assertEqual(self.registry.take_orphaned_handles(), ["cachedContents/a"])
+
+        self.now = 100
+        self.assertIsNone(self.registry.get("b"))
+        self.assertEqual(self.registry.take_orphaned_handles(), ["cachedContents/b"])
+        self.assertEqual(self.registry.take_orphaned_handles(), [])
+
+    def test_oversized_entry_is_not_stored(self):
+        self.assertFalse(self.registry.put(_context("big", size=(20, 20))))
+        self.assertEqual(len(self.registry), 0)
+
+
+# ==========================================
+#  2. 試穿流程 + 模型端快取 (假 client)
+# ==========================================
+class ContextCachingTryOnTests(TempMediaRootMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = FakeClient()
+        self.registry = GarmentContextRegistry(ttl_seconds=3600)
+        self.processor = AIProcessor(client=self.client, registry=self.registry)
+        self.processor.model_name = "test-synthesis-model"
+
+    def _try_on(self):
+        return self.processor.virtual_try_on(_png((10, 200, 10, 255)), _png((250, 100, 150, 255)))
+
+    def test_miss_then_hit_creates_remote_cache(self):
+        self._try_on()
+        first = self.client.models.synthesis_calls()[-1]
+        self.assertIsNone(first["config"])
+        self.assertEqual(len(first["contents"]), 5)   # 衣服 + 材質 + 前綴 + 模特兒 + 後綴
+        self.assertEqual(self.client.caches.created, [])
+        consultant_calls = len(self.client.models.calls) - 1
+
+        self._try_on()
+        second = self.client.models.synthesis_calls()[-1]
+        self.assertEqual(len(self.client.caches.created), 1)
+        self.assertEqual(self.client.caches.created[0]["model"], "test-synthesis-model")
+        self.assertEqual(second["config"], {"cached_content": "cachedContents/1"})
+        self.assertEqual(len(second["contents"]), 2)  # 只送模特兒 + 後綴
+        # 命中時不再呼叫顧問模型
+        self.assertEqual(len(self.client.models.calls), consultant_calls + 2)
+
+    def test_stale_cache_handle_falls_back_to_inline_prompt(self):
+        self._try_on()
+        self._try_on()
+        self.client.stale_caches.add("cachedContents/1")
+
+        result_path, _ = self._try_on()
+        self.assertTrue(result_path)
+
+        calls = self.client.models.synthesis_calls()
+        self.assertEqual(calls[-2]["config"], {"cached_content": "cachedContents/1"})
+        self.assertIsNone(calls[-1]["config"])
+        self.assertEqual(len(calls[-1]["contents"]), 5)
+
+        ctx = next(iter(self.registry._entries.values()))
+        self.assertIsNone(ctx.cache_name)
+        self.assertTrue(ctx.cache_failed)
+
+    def test_upstream_error_is_not_treated_as_stale_cache(self):
+        self._try_on()
+        self._try_on()
+        self.client.synthesis_error = FakeAPIError(429, "RESOURCE_EXHAUSTED")
+        calls_before = len(self.client.models.synthesis_calls())
+
+        with self.assertRaises(FakeAPIError):
+            self._try_on()
+        # 不重送完整前綴，也不放棄模型端快取
+        self.assertEqual(len(self.client.models.synthesis_calls()), calls_before + 1)
+        ctx = next(iter(self.registry._entries.values()))
+        self.assertEqual(ctx.cache_name, "cachedContents/1")
+        self.assertFalse(ctx.cache_failed)
+
+    def test_evicted_entry_deletes_remote_cache(self):
+        self._try_on()
+        self._try_on()
+        self.assertEqual(len(self.client.caches.created), 1)
+        # 只容得下一件衣服：換一件就會淘汰前一件
+        self.registry.max_bytes = self.registry.total_bytes
+        self.processor.virtual_try_on(_png((10, 200, 10, 255)), _png((20, 40, 220, 255)))
+        self.assertEqual(self.client.caches.deleted, ["cachedContents/1"])
+        self.assertEqual(self.registry.take_orphaned_handles(), [])
+
+    def test_failed_consultant_call_is_not_cached(self):
+        self.client.fail_analysis = True
+        _, analysis = self._try_on()
+        self.assertIn("Clothing item", analysis)
+        self.assertEqual(len(self.registry), 0)
+
+    def test_cached_garment_image_is_downscaled(self):
+        self.processor.virtual_try_on(_png((10, 200, 10, 255)), _png((250, 100, 150, 255), size=(3000, 1500)))
+        ctx = next(iter(self.registry._entries.values()))
+        self.assertLessEqual(max(ctx.prefix_contents[0].size), 1024)
+
+
+# ==========================================
+#  3. 准入控制：合成之後不丟棄已生成的結果 (品管忙碌時略過)
+# ==========================================
+class NoSheddingAfterSynthesisTests(TempMediaRootMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.processor = AIProcessor(client=FakeClient(), registry=GarmentContextRegistry())
+        self.processor.model_name = "test-synthesis-model"
+
+    def _busy(self, *args, **kwargs):
+        raise Overloaded("io", "queue_full", 1)
+
+    def test_quality_check_is_skipped_when_busy(self):
+        result_path, _ = self.processor.virtual_try_on(_png((10, 200, 10, 255)), _png((250, 100, 150, 255)))
+        self.processor.client.models.generate_content = self._busy
+        self.assertEqual(self.processor._check_result_quality(result_path, result_path), (True, "QA Skipped (busy)"))
+
+
+# ==========================================
+#  4. 輸出變體 (尺寸檔位 / ETag 快取)
+# ==========================================
+class OutputVariantTests(TempMediaRootMixin, SimpleTestCase):
+    def test_max_edge_snaps_down_with_floor(self):
+        edges = {raw: parse_output_spec({"format": "jpeg", "max_edge": raw}).max_edge
+                 for raw in ("100", "300", "512", "1500", "5000")}
+        self.assertEqual(edges, {"100": 256, "300": 256, "512": 512, "1500": 1024, "5000": 2048})
+
+    def test_variant_hit_does_not_rehash_etag(self):
+        source = os.path.join(self.media_root, "tryon_result_test.png")
+        Image.new("RGB", (64, 64), (200, 10, 10)).save(source)
+        spec = parse_output_spec({"format": "jpeg"})
+
+        with mock.patch("ai_app.services.results.hashlib.sha256", wraps=hashlib.sha256) as sha256:
+            etags = {content_etag(get_variant_path(source, spec)) for _ in range(3)}
+        self.assertEqual(len(etags), 1)
+        self.assertEqual(sha256.call_count, 1)
+
+
+# ==========================================
+#  5. 結果下載 (Range / ETag / 304 / 206 / 416)
+# ==========================================
+class RangeAndETagTests(SimpleTestCase):
+    def test_parse_range(self):
+        self.assertEqual(parse_range("bytes=0-9", 100), (0, 9))
+        self.assertEqual(parse_range("bytes=90-", 100), (90, 99))
+        self.assertEqual(parse_range("bytes=90-500", 100), (90, 99))
+        self.assertEqual(parse_range("bytes=-10", 100), (90, 99))
+        self.assertEqual(parse_range("bytes=-500", 100), (0, 99))
+
+    def test_invalid_range_is_ignored(self):
+        for header in (None, "", "items=0-1", "bytes=5-3", "bytes=a-b", "bytes=0-1,5-6", "bytes=5"):
+            self.assertIsNone(parse_range(header, 100), header)
+
+    def test_unsatisfiable_range(self):
+        for header in ("bytes=100-", "bytes=200-300", "bytes=-0"):
+            with self.assertRaises(RangeNotSatisfiable, msg=header):
+                parse_range(header, 100)
+
+    def test_etag_matches(self):
+        self.assertTrue(etag_matches('"abc"', '"abc"'))
+        self.assertTrue(etag_matches('W/"abc"', '"abc"'))
+        self.assertTrue(etag_matches('"x", "abc"', '"abc"'))
+        self.assertTrue(etag_matches("*", '"abc"'))
+        self.assertFalse(etag_matches('"x"', '"abc"'))
+        self.assertFalse(etag_matches(None, '"abc"'))
+
+
+class ResultViewTests(TempMediaRootMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.result_id = "tryon_result_test"
+        Image.new("RGB", (64, 64), (10, 10, 200)).save(os.path.join(self.media_root, f"{self.result_id}.png"))
+        self.url = reverse('result', args=[self.result_id])
+
+    def test_full_then_not_modified(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], "image/png")
+        etag = response['ETag']
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_partial_content(self):
+        full = b"".join(self.client.get(self.url).streaming_content)
+        response = self.client.get(self.url, HTTP_RANGE="bytes=0-9")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f"bytes 0-9/{len(full)}")
+        self.assertEqual(b"".join(response.streaming_content), full[:10])
+
+    def test_range_ignored_when_if_range_does_not_match(self):
+        response = self.client.get(self.url, HTTP_RANGE="bytes=0-9", HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_unsatisfiable_and_invalid_ranges(self):
+        size = os.path.getsize(os.path.join(self.media_root, f"{self.result_id}.png"))
+        response = self.client.get(self.url, HTTP_RANGE=f"bytes={size}-")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f"bytes */{size}")
+        self.assertEqual(self.client.get(self.url, HTTP_RANGE="bytes=5-3").status_code, 200)
+
+    def test_unknown_result_is_404(self):
+        self.assertEqual(self.client.get(reverse('result', args=["missing"])).status_code, 404)
+
+
+# ==========================================
+#  6. 串流試穿 (SSE 事件順序 / 重試 / 忙碌時交付上一版)
+# ==========================================
+class TryCombineStreamTests(TempMediaRootMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.fake = FakeClient()
+        self.processor = AIProcessor(client=self.fake, registry=GarmentContextRegistry())
+        self.processor.model_name = "test-synthesis-model"
+        patcher = mock.patch("ai_app.views.AIProcessor", return_value=self.processor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _stream(self):
+        response = self.client.post(reverse('try_combine_stream'), {
+            "model_image": SimpleUploadedFile("model.png", _png((10, 200, 10, 255)).read(), "image/png"),
+            "garment_image": SimpleUploadedFile("cloth.png", _png((250, 100, 150, 255)).read(), "image/png"),
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith("text/event-stream"))
+        body = b"".join(response.streaming_content).decode("utf-8")
+        events = []
+        for block in body.strip().split("\n\n"):
+            event_line, data_line = block.split("\n")
+            events.append((event_line[len("event: "):], json.loads(data_line[len("data: "):])))
+        return events
+
+    def _assert_result_link(self, data):
+        self.assertNotIn("result_path", data)
+        self.assertEqual(data["result_url"], reverse('result', args=[data["result_id"]]))
+        self.assertTrue(os.path.isfile(os.path.join(self.media_root, f"{data['result_id']}.png")))
+
+    def test_event_order(self):
+        events = self._stream()
+        self.assertEqual([name for name, _ in events], [
+            "garment_prepared", "color", "analysis",
+            "synthesis_started", "model_text", "image", "qa", "done",
+        ])
+        data = dict(events)
+        self.assertEqual(data["model_text"]["text"], "Rendering")
+        self._assert_result_link(data["image"])
+        self.assertEqual(data["done"]["result_id"], data["image"]["result_id"])
+        self.assertIn("結構檢查通過", data["done"]["analysis"])
+
+    def test_failed_qa_retries_with_correction(self):
+        self.fake.qa_verdicts = [(False, "sleeves missing")]
+        events = self._stream()
+        names = [name for name, _ in events]
+        self.assertEqual(names.count("synthesis_started"), 2)
+        self.assertEqual(names[-1], "done")
+
+        images = [data for name, data in events if name == "image"]
+        self.assertEqual([image["attempt"] for image in images], [0, 1])
+        self.assertNotEqual(images[0]["result_id"], images[1]["result_id"])
+        self.assertEqual(events[-1][1]["result_id"], images[1]["result_id"])
+        # 第二次合成帶修正指令
+        retry_prompt = self.fake.models.synthesis_calls()[-1]["contents"][-1]
+        self.assertIn("sleeves missing", retry_prompt)
+
+    def test_busy_retry_delivers_previous_result(self):
+        self.fake.qa_verdicts = [(False, "sleeves missing")]
+        self.fake.stream_failures = {1: Overloaded("io", "queue_full", 1)}
+        events = self._stream()
+        self.assertNotIn("error", [name for name, _ in events])
+
+        image = next(data for name, data in events if name == "image")
+        name, done = events[-1]
+        self.assertEqual(name, "done")
+        self._assert_result_link(done)
+        self.assertEqual(done["result_id"], image["result_id"])
+        self.assertIn("系統忙碌未修復", done["analysis"])
+
+    def test_busy_first_attempt_is_an_error_event(self):
+        self.fake.stream_failures = {0: Overloaded("io", "queue_full", 1)}
+        name, data = self._stream()[-1]
+        self.assertEqual(name, "error")
+        self.assertEqual(data["code"], 503)
+        self.assertEqual(data["retry_after"], 1)
+
+
+# ==========================================
+#  7. 准入池 (排隊/逾時拒絕、名額歸還、503、監控指標)
+# ==========================================
+class WorkPoolTests(SimpleTestCase):
+    def test_rejects_when_queue_is_full(self):
+        pool = WorkPool("test", max_workers=1, max_queue=0, max_wait=5)
+        ticket = pool.acquire()
+        with self.assertRaises(Overloaded) as raised:
+            pool.acquire()
+        self.assertEqual(raised.exception.reason, "queue_full")
+        self.assertEqual(raised.exception.retry_after, 5)
+        ticket.release()
+        ticket.release()   # 重複歸還只算一次
+        pool.acquire().release()
+
+        stats = pool.stats()
+        self.assertEqual((stats["active"], stats["queued"], stats["admitted"]), (0, 0, 2))
+        self.assertEqual(stats["rejected"], {"queue_full": 1, "timeout": 0})
+
+    def test_rejects_after_max_wait(self):
+        pool = WorkPool("test", max_workers=1, max_queue=1, max_wait=0.01)
+        with pool.slot():
+            with self.assertRaises(Overloaded) as raised:
+                pool.acquire()
+            self.assertEqual(raised.exception.reason, "timeout")
+            self.assertEqual(raised.exception.retry_after, 1)
+            self.assertEqual(pool.stats()["active"], 1)
+        stats = pool.stats()
+        self.assertEqual((stats["active"], stats["queued"]), (0, 0))
+        self.assertEqual(stats["rejected"], {"queue_full": 0, "timeout": 1})
+
+    def test_stream_closed_before_iteration_returns_ticket(self):
+        pool = WorkPool("test", max_workers=1, max_queue=0, max_wait=0.01)
+
+        def events():
+            yield "never started"
+
+        stream = ReleasingStream(events(), pool.acquire())
+        stream.close()
+        self.assertEqual(pool.stats()["active"], 0)
+        pool.acquire().release()
+
+    def test_stream_returns_ticket_when_exhausted(self):
+        pool = WorkPool("test", max_workers=1, max_queue=0, max_wait=0.01)
+        self.assertEqual(list(ReleasingStream(iter(["a", "b"]), pool.acquire())), ["a", "b"])
+        self.assertEqual(pool.stats()["active"], 0)
+
+
+class AdmissionViewTests(SimpleTestCase):
+    def setUp(self):
+        # 用獨立的池，不影響其他測試共用的全域池
+        patcher = mock.patch.dict("ai_app.services.admission._pools", {
+            "results": WorkPool("results", max_workers=1, max_queue=0, max_wait=3),
+        })
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_full_endpoint_pool_returns_503_with_retry_after(self):
+        ticket = get_pool("results").acquire()
+        self.addCleanup(ticket.release)
+
+        response = self.client.get(reverse('result', args=["missing"]))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], "3")
+        self.assertEqual(response.json()["code"], 503)
+
+    def test_metrics_groups_samples_per_family(self):
+        ticket = get_pool("results").acquire()
+        self.client.get(reverse('result', args=["missing"]))
+        ticket.release()
+
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith("text/plain; version=0.0.4"))
+        lines = response.content.decode().splitlines()
+        self.assertIn('ai_pool_rejected_total{pool="results",reason="queue_full"} 1', lines)
+        self.assertIn('ai_pool_admitted_total{pool="results"} 1', lines)
+        self.assertIn('ai_pool_max_workers{pool="results"} 1', lines)
+
+        # 每個指標：HELP、TYPE 之後緊接著它的全部樣本
+        families = [line.split()[2] for line in lines if line.startswith("# TYPE")]
+        samples = [line.split("{")[0] for line in lines if not line.startswith("#")]
+        self.assertEqual([name for i, name in enumerate(samples) if i == 0 or samples[i - 1] != name], families)
+        for name in families:
+            self.assertEqual(samples.count(name) % len(settings.AI_POOLS), 0)
@@ -1,9 +1,20 @@
 from django.urls import path
-from .views import RemoveBgView, TryCombineView, DebugPageView
+from .views import (
+    RemoveBgView, TryCombineView, TryCombineStreamView, ResultView,
+    HealthzView, ReadyzView, MetricsView, DebugPageView,
+)
 
 urlpatterns = [
     # API 路徑 (對應 Excel 定義)
     path('api/remove_bg', RemoveBgView.as_view(), name='remove_bg'),
     path('api/try_combine', TryCombineView.as_view(), name='try_combine'),
+    path('api/try_combine/stream', TryCombineStreamView.as_view(), name='try_combine_stream'),
+    path('api/results/<slug:result_id>', ResultView.as_view(), name='result'),
+
+    # 健康檢查 (給 orchestrator 探測用)
+    path('healthz', HealthzView.as_view(), name='healthz'),
+    path('readyz', ReadyzView.as_view(), name='readyz'),
+    path('metrics', MetricsView.as_view(), name='metrics'),
+    path('debug', DebugPageView.as_view(), name='debug'),
     
 ]
\ No newline at end of file
@@ -1,20 +1,79 @@
+import io
 import os
+import json
 import logging
+import functools
 from urllib.parse import quote  # <--- [修正 1] 補上這個工具
 from django.conf import settings
-from django.http import JsonResponse, FileResponse
+from django.http import JsonResponse, FileResponse, HttpResponse, StreamingHttpResponse
+from django.urls import reverse
 from django.views import View
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from .services.processing import AIProcessor
+from .services.encoding import OutputFormatError, VariantEncodeError, parse_output_spec, get_variant_path
+from .services.runtime import readiness, start_background_warmup, uptime_seconds
+from .services.admission import Overloaded, ReleasingStream, all_pool_stats, get_pool
+from .services.results import (
+    RangeNotSatisfiable, content_etag, etag_matches, iter_file_range,
+    parse_range, resolve_result_path, result_id_for, sendfile_header,
+)
 
 # [修正 2] 初始化 System Log (UART Init)
 logger = logging.getLogger(__name__)
 
+# ==========================================
+#  0. 共用：輸出格式協商 + 回傳圖片
+# ==========================================
+def _get_output_spec(request):
+    # format/quality/max_edge 可放在 query string 或 multipart 表單
+    params = request.GET.copy()
+    for key in ("format", "quality", "lossless", "max_edge"):
+        if key in request.POST:
+            params[key] = request.POST[key]
+    return parse_output_spec(params, request.headers.get('Accept', ''))
+
+
+def _build_image_response(result_path, spec, download_stem):
+    # 端點池已限制同時數；結果已經算出來，轉檔不再做負載丟棄
+    variant_path = get_variant_path(result_path, spec, admission=False)
+    response = FileResponse(open(variant_path, 'rb'), content_type=spec.content_type)
+    response['Content-Disposition'] = f'attachment; filename="{download_stem}.{spec.extension}"'
+    response['Vary'] = 'Accept'
+    # 讓客戶端/CDN 之後可用 GET /api/results/<id> 重新取得
+    result_id = result_id_for(result_path)
+    response['X-Result-Id'] = result_id
+    response['X-Result-URL'] = reverse('result', args=[result_id])
+    return response
+
+# ==========================================
+#  0-1. 共用：准入控制 (過載時 503 + Retry-After)
+# ==========================================
+def _overloaded_response(e):
+    logger.warning(f"🚦 [Admission] 拒絕請求: {e.pool} ({e.reason})")
+    response = JsonResponse({"code": 503, "message": f"服務忙碌中，請稍後再試 ({e.pool}: {e.reason})"}, status=503)
+    response['Retry-After'] = str(e.retry_after)
+    return response
+
+
+def admission_gate(pool_name):
+    """端點層級的准入：同時處理數、排隊數、等待時間都有上限。"""
+    def decorator(view_func):
+        @functools.wraps(view_func)
+        def wrapped(request, *args, **kwargs):
+            try:
+                with get_pool(pool_name).slot():
+                    return view_func(request, *args, **kwargs)
+            except Overloaded as e:
+                return _overloaded_response(e)
+        return wrapped
+    return decorator
+
 # ==========================================
 #  1. 去背功能 (Remove Background)
 # ==========================================
 @method_decorator(csrf_exempt, name='dispatch')
+@method_decorator(admission_gate('remove_bg'), name='post')
 class RemoveBgView(View):
     def post(self, request, *args, **kwargs):
         # --- [檢查 1] 是否有上傳檔案 (400) ---
@@ -29,6 +88,12 @@ class RemoveBgView(View):
             logger.warning(f"⚠️ [RemoveBg] 格式錯誤: {clothes_image.content_type}")
             return JsonResponse({"code": 415, "message": "不支援的檔案格式 (Unsupported Media Type)"}, status=415)
 
+        # --- [檢查 3] 輸出格式參數 (400/406)，在運算前先擋掉 ---
+        try:
+            spec = _get_output_spec(request)
+        except OutputFormatError as e:
+            return JsonResponse({"code": e.status, "message": str(e)}, status=e.status)
+
         try:
             processor = AIProcessor()
             logger.info(f"🔄 [RemoveBg] 開始去背: {clothes_image.name}")
@@ -36,20 +101,25 @@ class RemoveBgView(View):
             # 呼叫去背 (單一回傳值)
             result_path = processor.remove_background(clothes_image)
             
-            # --- [檢查 3] 結果檔案是否存在 (500) ---
+            # --- [檢查 4] 結果檔案是否存在 (500) ---
             if not os.path.exists(result_path):
                 logger.error("❌ [RemoveBg] 找不到輸出檔")
                 return JsonResponse({"code": 500, "message": "檔案處理失敗，找不到結果檔"}, status=500)
 
             # --- [成功] 回傳檔案 ---
-            filename = os.path.basename(result_path)
-            response = FileResponse(open(result_path, 'rb'), content_type='image/png')
-            response['Content-Disposition'] = f'attachment; filename="{filename}"'
+            filename = os.path.splitext(os.path.basename(result_path))[0]
+            response = _build_image_response(result_path, spec, filename)
             response['X-Message'] = 'Success'
             
             logger.info(f"✅ [RemoveBg] 成功回傳: {filename}")
             return response
 
+        except Overloaded as e:
+            return _overloaded_response(e)
+
+        except VariantEncodeError as e:
+            return JsonResponse({"code": 500, "message": str(e)}, status=500)
+
         except OSError:
             logger.error("❌ [RemoveBg] 圖片損壞")
             return JsonResponse({"code": 422, "message": "圖片過於模糊或損壞"}, status=422)
@@ -62,6 +132,7 @@ class RemoveBgView(View):
 #  2. 虛擬試穿 (Virtual Try-On)
 # ==========================================
 @method_decorator(csrf_exempt, name='dispatch')
+@method_decorator(admission_gate('try_combine'), name='post')
 class TryCombineView(View):
     def post(self, request, *args, **kwargs):
         # [修正 3] 補回完整的輸入檢查邏輯 (這是必要的電路，不能省略)
@@ -75,6 +146,11 @@ class TryCombineView(View):
         if not model_image.content_type.startswith('image/') or not clothes_image.content_type.startswith('image/'):
             return JsonResponse({"code": 415, "message": "不支援的檔案格式"}, status=415)
 
+        try:
+            spec = _get_output_spec(request)
+        except OutputFormatError as e:
+            return JsonResponse({"code": e.status, "message": str(e)}, status=e.status)
+
         try:
             processor = AIProcessor()
             logger.info("🔄 [TryOn] 開始 AI 試穿合成...")
@@ -85,11 +161,8 @@ class TryCombineView(View):
             if not os.path.exists(result_path):
                 raise FileNotFoundError("合成完成但找不到輸出檔")
 
-            filename = os.path.basename(result_path)
-            
-            # 準備回傳圖片
-            response = FileResponse(open(result_path, 'rb'), content_type='image/png')
-            response['Content-Disposition'] = f'attachment; filename="tryon_result.png"'
+            # 準備回傳圖片 (依協商結果轉檔/縮圖)
+            response = _build_image_response(result_path, spec, "tryon_result")
             
             # 將文字注入到 Header (Sideband Signal)
             # 使用 quote 將中文轉碼，防止 HTTP Header 亂碼
@@ -99,6 +172,12 @@ class TryCombineView(View):
             logger.info(f"✅ [TryOn] 成功回傳圖片與分析文字")
             return response
 
+        except Overloaded as e:
+            return _overloaded_response(e)
+
+        except VariantEncodeError as e:
+            return JsonResponse({"code": 500, "message": str(e)}, status=500)
+
         except OSError:
              return JsonResponse({"code": 422, "message": "圖片過於模糊或損壞"}, status=422)
 
@@ -107,7 +186,197 @@ class TryCombineView(View):
             return JsonResponse({"code": 500, "message": str(e)}, status=500)
 
 # ==========================================
-#  3. Debug 頁面
+#  2-1. 虛擬試穿 (SSE 串流版)
+# ==========================================
+def _sse_event(event, data):
+    payload = json.dumps(data, ensure_ascii=False)
+    return f"event: {event}\ndata: {payload}\n\n"
+
+
+def _stream_try_on_events(processor, model_image, clothes_image):
+    try:
+        for event, data in processor.virtual_try_on_events(model_image, clothes_image):
+            # 本機路徑不外流：轉成結果 id 與下載網址
+            result_path = data.pop("result_path", None)
+            if result_path:
+                result_id = result_id_for(result_path)
+                data["result_id"] = result_id
+                data["result_url"] = reverse('result', args=[result_id])
+            logger.info(f"📡 [TryOnStream] {event}")
+            yield _sse_event(event, data)
+
+    except Overloaded as e:
+        logger.warning(f"🚦 [TryOnStream] 階段池忙碌: {e.pool} ({e.reason})")
+        yield _sse_event("error", {"code": 503, "message": str(e), "retry_after": e.retry_after})
+
+    except OSError:
+        yield _sse_event("error", {"code": 422, "message": "圖片過於模糊或損壞"})
+
+    except Exception as e:
+        logger.error(f"❌ [TryOnStream] 系統錯誤: {str(e)}")
+        yield _sse_event("error", {"code": 500, "message": str(e)})
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class TryCombineStreamView(View):
+    def post(self, request, *args, **kwargs):
+        model_image = request.FILES.get('model_image')
+        clothes_image = request.FILES.get('garment_image') or request.FILES.get('clothes_image')
+
+        if not model_image or not clothes_image:
+            logger.warning("⚠️ [TryOnStream] 缺少必要參數")
+            return JsonResponse({"code": 400, "message": "缺少參數 (Missing: model_image or garment_image)"}, status=400)
+
+        if not model_image.content_type.startswith('image/') or not clothes_image.content_type.startswith('image/'):
+            return JsonResponse({"code": 415, "message": "不支援的檔案格式"}, status=415)
+
+        # 與 /api/try_combine 共用端點池；名額在串流結束 (或中斷) 時才歸還
+        try:
+            ticket = get_pool('try_combine').acquire()
+        except Overloaded as e:
+            return _overloaded_response(e)
+
+        # 串流期間上傳檔可能已被關閉，先讀進記憶體
+        model_buffer = io.BytesIO(model_image.read())
+        clothes_buffer = io.BytesIO(clothes_image.read())
+
+        processor = AIProcessor()
+        logger.info("🔄 [TryOnStream] 開始串流試穿...")
+
+        response = StreamingHttpResponse(
+            ReleasingStream(_stream_try_on_events(processor, model_buffer, clothes_buffer), ticket),
+            content_type='text/event-stream; charset=utf-8',
+        )
+        response['Cache-Control'] = 'no-cache'
+        # 關閉 nginx 緩衝，事件才會即時送出
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+# ==========================================
+#  3. 結果下載 (ETag / Range / Sendfile)
+# ==========================================
+@method_decorator(admission_gate('results'), name='get')
+class ResultView(View):
+    def get(self, request, result_id, *args, **kwargs):
+        result_path = resolve_result_path(result_id)
+        if not result_path:
+            return JsonResponse({"code": 404, "message": f"找不到結果: {result_id}"}, status=404)
+
+        try:
+            spec = _get_output_spec(request)
+        except OutputFormatError as e:
+            return JsonResponse({"code": e.status, "message": str(e)}, status=e.status)
+
+        try:
+            variant_path = get_variant_path(result_path, spec)
+        except Overloaded as e:
+            return _overloaded_response(e)
+        except VariantEncodeError:
+            logger.error(f"❌ [Result] 轉檔失敗: {result_id} -> {spec.key}")
+            return JsonResponse({"code": 500, "message": "結果轉檔失敗"}, status=500)
+
+        etag = content_etag(variant_path)
+        size = os.path.getsize(variant_path)
+        max_age = getattr(settings, 'AI_RESULT_CACHE_MAX_AGE', 31536000)
+        headers = {
+            'ETag': etag,
+            # 結果檔內容不會變 (id 含亂數)，可長期快取
+            'Cache-Control': f'public, max-age={max_age}, immutable',
+            'Vary': 'Accept',
+            'Accept-Ranges': 'bytes',
+        }
+
+        # --- [快取驗證] If-None-Match -> 304 ---
+        if etag_matches(request.headers.get('If-None-Match'), etag):
+            response = HttpResponse(status=304)
+            for key, value in headers.items():
+                response[key] = value
+            return response
+
+        disposition = f'inline; filename="{result_id}.{spec.extension}"'
+
+        # --- [卸載] 交給前端代理送檔 (Range 也由代理處理) ---
+        offload = sendfile_header(variant_path)
+        if offload:
+            response = HttpResponse(content_type=spec.content_type)
+            response[offload[0]] = offload[1]
+            response['Content-Disposition'] = disposition
+            for key, value in headers.items():
+                response[key] = value
+            return response
+
+        # --- [Range] 單一區段 -> 206；If-Range 不符時回傳完整檔 ---
+        byte_range = None
+        if_range = request.headers.get('If-Range')
+        if not if_range or if_range == etag:
+            try:
+                byte_range = parse_range(request.headers.get('Range'), size)
+            except RangeNotSatisfiable:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = f'bytes */{size}'
+                return response
+
+        if byte_range:
+            start, end = byte_range
+            length = end - start + 1
+            response = StreamingHttpResponse(
+                iter_file_range(variant_path, start, length),
+                status=206, content_type=spec.content_type,
+            )
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+            response['Content-Length'] = str(length)
+        else:
+            response = FileResponse(open(variant_path, 'rb'), content_type=spec.content_type)
+
+        response['Content-Disposition'] = disposition
+        for key, value in headers.items():
+            response[key] = value
+        return response
+
+# ==========================================
+#  4. 健康檢查 (liveness / readiness) + 監控指標
+# ==========================================
+class HealthzView(View):
+    def get(self, request):
+        # 只要程序能回應就是活著：不碰模型，也不讀任何共用狀態/鎖
+        return JsonResponse({"status": "alive", "uptime_seconds": uptime_seconds()})
+
+
+class ReadyzView(View):
+    def get(self, request):
+        ready, report = readiness()
+        if not ready:
+            # 尚未預熱 (例如測試環境) 或上次預熱失敗：觸發 (退避後) 重試
+            start_background_warmup()
+        return JsonResponse({"ready": ready, **report}, status=200 if ready else 503)
+
+class MetricsView(View):
+    def get(self, request):
+        # Prometheus 文字格式：各池的執行中/排隊數與拒絕次數 (同一指標的樣本需連在一起)
+        pool_stats = all_pool_stats()
+        families = [
+            ("ai_pool_active", "gauge", "Work currently running in the pool.", "active"),
+            ("ai_pool_queued", "gauge", "Requests waiting for a pool slot.", "queued"),
+            ("ai_pool_max_workers", "gauge", "Configured pool concurrency.", "max_workers"),
+            ("ai_pool_max_queue", "gauge", "Configured pool queue limit.", "max_queue"),
+            ("ai_pool_admitted_total", "counter", "Requests admitted into the pool.", "admitted"),
+        ]
+        lines = []
+        for metric, kind, help_text, field in families:
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} {kind}")
+            for name, stats in pool_stats.items():
+                lines.append(f'{metric}{{pool="{name}"}} {stats[field]}')
+
+        lines.append("# HELP ai_pool_rejected_total Requests rejected by the pool.")
+        lines.append("# TYPE ai_pool_rejected_total counter")
+        for name, stats in pool_stats.items():
+            for reason, count in stats["rejected"].items():
+                lines.append(f'ai_pool_rejected_total{{pool="{name}",reason="{reason}"}} {count}')
+        return HttpResponse("\n".join(lines) + "\n", content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# ==========================================
+#  5. Debug 頁面
 # ==========================================
 class DebugPageView(View):
     def get(self, request):
@@ -117,6 +386,11 @@ class DebugPageView(View):
             "message": "AI Core Server is Online",
             "api_endpoints": [
                 "/api/remove_bg",
-                "/api/try_combine"
+                "/api/try_combine",
+                "/api/try_combine/stream",
+                "/api/results/<id>",
+                "/healthz",
+                "/readyz",
+                "/metrics"
             ]
         })
\ No newline at end of file
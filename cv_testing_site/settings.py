@@ -125,4 +125,63 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # 設定圖片上傳的路徑
 MEDIA_URL = '/media/'
-MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
\ No newline at end of file
+MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+
+# 結果下載 (/api/results/<id>)
+# AI_RESULT_SENDFILE: "" (Django 直接送檔) / "x-accel-redirect" (nginx) / "x-sendfile" (Apache)
+AI_RESULT_SENDFILE = os.getenv('AI_RESULT_SENDFILE', '')
+# nginx internal location，需對應到 MEDIA_ROOT
+AI_RESULT_ACCEL_PREFIX = os.getenv('AI_RESULT_ACCEL_PREFIX', '/protected-media/')
+AI_RESULT_CACHE_MAX_AGE = int(os.getenv('AI_RESULT_CACHE_MAX_AGE', 60 * 60 * 24 * 365))
+
+# 轉檔變體快取 (media/variants) 清理：最久保留秒數 / 總大小上限 / 清理間隔
+AI_VARIANT_MAX_AGE = int(os.getenv('AI_VARIANT_MAX_AGE', 60 * 60 * 24 * 7))
+AI_VARIANT_MAX_BYTES = int(os.getenv('AI_VARIANT_MAX_BYTES', 1024 ** 3))
+AI_VARIANT_PRUNE_INTERVAL = int(os.getenv('AI_VARIANT_PRUNE_INTERVAL', 600))
+
+# 准入控制 (Admission Control)
+# 每個池：max_workers 同時執行數 / max_queue 最大排隊數 / max_wait 最長等待秒數
+# 超過就回 503 + Retry-After
+_CPU_COUNT = os.cpu_count() or 1
+AI_POOLS = {
+    # 階段池：去背 (rembg)、其他 CPU 運算 (PIL 轉檔/取色) 與 I/O (Gemini 呼叫) 分開計算，
+    # 去背尖峰不會吃掉試穿需要的 cpu 名額
+    'matting': {
+        'max_workers': int(os.getenv('AI_MATTING_WORKERS', _CPU_COUNT)),
+        'max_queue': int(os.getenv('AI_MATTING_QUEUE', _CPU_COUNT * 2)),
+        'max_wait': float(os.getenv('AI_MATTING_MAX_WAIT', 10)),
+    },
+    'cpu': {
+        'max_workers': int(os.getenv('AI_CPU_WORKERS', _CPU_COUNT)),
+        'max_queue': int(os.getenv('AI_CPU_QUEUE', _CPU_COUNT * 2)),
+        'max_wait': float(os.getenv('AI_CPU_MAX_WAIT', 10)),
+    },
+    # 公開 GET 產生新變體 (AVIF / 無損 WebP 很吃 CPU) 用的編碼池，與試穿的 cpu 池分開
+    'encode': {
+        'max_workers': int(os.getenv('AI_ENCODE_WORKERS', max(1, _CPU_COUNT // 2))),
+        'max_queue': int(os.getenv('AI_ENCODE_QUEUE', _CPU_COUNT * 2)),
+        'max_wait': float(os.getenv('AI_ENCODE_MAX_WAIT', 10)),
+    },
+    'io': {
+        'max_workers': int(os.getenv('AI_IO_WORKERS', 16)),
+        'max_queue': int(os.getenv('AI_IO_QUEUE', 32)),
+        'max_wait': float(os.getenv('AI_IO_MAX_WAIT', 15)),
+    },
+    # 端點池：每個 API 同時處理的請求數
+    # remove_bg 預設不超過 matting 池的容量，多出來的請求在入口就排隊/拒絕
+    'remove_bg': {
+        'max_workers': int(os.getenv('AI_REMOVE_BG_CONCURRENCY', _CPU_COUNT)),
+        'max_queue': int(os.getenv('AI_REMOVE_BG_QUEUE', _CPU_COUNT * 2)),
+        'max_wait': float(os.getenv('AI_REMOVE_BG_MAX_WAIT', 5)),
+    },
+    'try_combine': {
+        'max_workers': int(os.getenv('AI_TRY_COMBINE_CONCURRENCY', 8)),
+        'max_queue': int(os.getenv('AI_TRY_COMBINE_QUEUE', 16)),
+        'max_wait': float(os.getenv('AI_TRY_COMBINE_MAX_WAIT', 5)),
+    },
+    'results': {
+        'max_workers': int(os.getenv('AI_RESULTS_CONCURRENCY', 32)),
+        'max_queue': int(os.getenv('AI_RESULTS_QUEUE', 64)),
+        'max_wait': float(os.getenv('AI_RESULTS_MAX_WAIT', 5)),
+    },
+}
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cv_testing_site.settings')
 
 application = get_wsgi_application()
+
+# 只有伺服器程序才預熱 AI 模型 (manage.py migrate 等指令不會載入這個檔案)
+if os.getenv('AI_WARMUP_ON_START', '1') != '0':
+    from ai_app.services.runtime import start_background_warmup
+    start_background_warmup()